@@ -16,6 +16,9 @@ main() {
     cp "${SCRIPT_DIR}/systemd/vaultwarden-backup.service" /etc/systemd/system
     cp "${SCRIPT_DIR}/systemd/vaultwarden-backup.timer" /etc/systemd/system
     sed -i "s|{{project_dir}}|${SCRIPT_DIR}|g" /etc/systemd/system/vaultwarden-backup.service
+    cp "${SCRIPT_DIR}/systemd/vaultwarden-backup-compact.service" /etc/systemd/system
+    cp "${SCRIPT_DIR}/systemd/vaultwarden-backup-compact.timer" /etc/systemd/system
+    sed -i "s|{{project_dir}}|${SCRIPT_DIR}|g" /etc/systemd/system/vaultwarden-backup-compact.service
     systemctl daemon-reexec
     systemctl daemon-reload
     echo "Success!"
@@ -1,41 +1,156 @@
+import fcntl
+import gzip
 import hashlib
 import logging
 import os
 import shutil
+import subprocess
+import tarfile
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 
-from plumbum.cmd import gpg, mkdir, mv, rclone, tar
+from plumbum.cmd import gpg, mkdir, mv, rclone
 
 l = logging.getLogger(__name__)  # noqa: E741
 
 
-def generate_checksums(file_path):
-    """Generate MD5 and SHA1 checksums for a file."""
+# Backup directories are named after their creation time, which orders them
+BACKUP_NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+# Held by backups for their whole run and by compaction only to swap in a generation
+LOCK_FILE = ".vaultwarden-backup.lock"
+# Held by compaction for its whole run, so two runs never share temporary files
+COMPACT_LOCK_FILE = ".vaultwarden-compact.lock"
+# Compacted archives are written next to their generation under this prefix
+COMPACT_TMP_PREFIX = ".compact-"
+
+# Same level as gzip/tar -z, level 9 costs a lot more CPU for little gain
+ARCHIVE_COMPRESS_LEVEL = 6
+
+
+def hash_file(file_path, throttle=None):
+    """Return the MD5 and SHA1 hash objects of a file."""
     md5_hash = hashlib.md5()
     sha1_hash = hashlib.sha1()
 
-    try:
-        with open(file_path, "rb") as f:
-            # Read file in chunks to handle large files efficiently
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-                sha1_hash.update(chunk)
+    with open(file_path, "rb") as f:
+        # Read file in chunks to handle large files efficiently
+        for chunk in iter(lambda: f.read(4096), b""):
+            md5_hash.update(chunk)
+            sha1_hash.update(chunk)
+            if throttle:
+                throttle.pace()
 
-        md5_sum = md5_hash.hexdigest()
-        sha1_sum = sha1_hash.hexdigest()
+    return md5_hash, sha1_hash
 
-        l.info(f"MD5: {md5_sum}  {os.path.basename(file_path)}")
-        l.info(f"SHA1: {sha1_sum}  {os.path.basename(file_path)}")
 
-        return md5_sum, sha1_sum
+def generate_checksums(file_path, throttle=None):
+    """Generate MD5 and SHA1 checksums for a file."""
+    try:
+        return _log_checksums(file_path, *hash_file(file_path, throttle))
 
     except Exception as e:
         l.error(f"Failed to generate checksums for {file_path}: {e}")
         raise
 
 
+def _log_checksums(file_path, md5_hash, sha1_hash):
+    md5_sum = md5_hash.hexdigest()
+    sha1_sum = sha1_hash.hexdigest()
+
+    l.info(f"MD5: {md5_sum}  {os.path.basename(file_path)}")
+    l.info(f"SHA1: {sha1_sum}  {os.path.basename(file_path)}")
+
+    return md5_sum, sha1_sum
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.md5_hash = hashlib.md5()
+        self.sha1_hash = hashlib.sha1()
+
+    def write(self, data):
+        self.md5_hash.update(data)
+        self.sha1_hash.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def write_checksums(file_path, checksums):
+    """Write SHA1 checksums in sha1sum format."""
+    with open(file_path, "w") as f:
+        for name, sha1_sum in checksums.items():
+            f.write(f"{sha1_sum}  {name}\n")
+
+
+def read_checksums(file_path):
+    """Read a sha1sum formatted file, missing files yield no checksums."""
+    if not os.path.exists(file_path):
+        return {}
+    checksums = {}
+    with open(file_path, "r") as f:
+        for line in f:
+            sha1_sum, _, name = line.rstrip("\n").partition("  ")
+            if name:
+                checksums[name] = sha1_sum
+    return checksums
+
+
+@contextmanager
+def gpg_encrypt_stream(target, passphrase):
+    """Yield gpg's stdin, everything written to it is encrypted into target."""
+    # stdin carries the data, so the passphrase goes through its own pipe
+    passphrase_fd, write_fd = os.pipe()
+    os.write(write_fd, passphrase.encode())
+    os.close(write_fd)
+    try:
+        process = gpg[
+            "--batch",
+            "--quiet",
+            "--yes",
+            "--passphrase-fd",
+            str(passphrase_fd),
+            "--symmetric",
+            "--cipher-algo",
+            "AES256",
+            "--output",
+            target,
+        ].popen(
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=(passphrase_fd,),
+        )
+    finally:
+        os.close(passphrase_fd)
+
+    try:
+        yield process.stdin
+        process.stdin.close()
+    except BrokenPipeError:
+        # gpg exited early, its own error says why
+        process.wait()
+        stderr = process.stderr.read()
+        raise Exception(f"gpg failed: {stderr.decode(errors='replace').strip()}")
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise Exception(f"gpg failed: {stderr.decode(errors='replace').strip()}")
+
+
+def _stage(throttle, name):
+    return throttle.stage(name) if throttle else nullcontext()
+
+
 def create_backup(cfg):
-    backup_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    backup_name = datetime.now().strftime(BACKUP_NAME_FORMAT)
     backup_dir = f"{cfg.backups_dir}/{backup_name}"
 
     try:
@@ -43,23 +158,71 @@ def create_backup(cfg):
         mkdir["-p", backup_dir]()
         mv[cfg.encrypted_archive_path(), backup_dir]()
         mv[cfg.keepass_db_path(), backup_dir]()
+        mv[cfg.checksums_path(), backup_dir]()
         l.info("Backup created successfully")
     except Exception as e:
         l.error(f"Failed to create backup: {e}")
         raise
 
 
+def _backup_time(name):
+    try:
+        return datetime.strptime(name, BACKUP_NAME_FORMAT)
+    except ValueError:
+        return None
+
+
+def list_backups(cfg):
+    """Return backup directories, newest first by the timestamp in their name."""
+    backups = []
+    for name in os.listdir(cfg.backups_dir):
+        path = os.path.join(cfg.backups_dir, name)
+        if not os.path.isdir(path):
+            continue
+        created = _backup_time(name)
+        if created is None:
+            l.debug(f"Ignoring directory not named like a backup: {path}")
+            continue
+        backups.append((created, path))
+    backups.sort(reverse=True)
+    return [path for _, path in backups]
+
+
+@contextmanager
+def backups_lock(cfg):
+    """Hold the exclusive backups_dir lock, waiting for the current holder."""
+    os.makedirs(cfg.backups_dir, exist_ok=True)
+    with open(os.path.join(cfg.backups_dir, LOCK_FILE), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            l.info("Backups directory is locked by another run, waiting...")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        l.debug(f"Locked {cfg.backups_dir}")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def previous_keepass_db_path(cfg):
+    """Return the KeePass database of the latest backup, if there is one."""
+    if not os.path.exists(cfg.backups_dir):
+        return None
+    for backup_dir in list_backups(cfg):
+        db_path = os.path.join(backup_dir, os.path.basename(cfg.keepass_db_path()))
+        if os.path.exists(db_path):
+            return db_path
+    return None
+
+
 def rotate_backups(cfg):
     if not os.path.exists(cfg.backups_dir):
         l.info("Backups directory doesn't exist, skipping rotation")
         return
 
     try:
-        backups = [
-            os.path.join(cfg.backups_dir, f) for f in os.listdir(cfg.backups_dir)
-        ]
-        backups = [f for f in backups if os.path.isdir(f)]
-        backups.sort(key=lambda f: os.path.getmtime(f), reverse=True)
+        backups = list_backups(cfg)
 
         to_delete = backups[cfg.backups_keep_last :]
 
@@ -88,7 +251,18 @@ def sync_backups(cfg):
             for attempt in range(0, cfg.sync_attempts):
                 try:
                     l.debug(f"Attempt {attempt}")
-                    rclone["sync", cfg.backups_dir, remote, "--progress"]()
+                    rclone[
+                        "sync",
+                        cfg.backups_dir,
+                        remote,
+                        "--exclude",
+                        f"/{LOCK_FILE}",
+                        "--exclude",
+                        f"/{COMPACT_LOCK_FILE}",
+                        "--exclude",
+                        f"/{COMPACT_TMP_PREFIX}*",
+                        "--progress",
+                    ]()
                     l.info(f"{remote} synced")
                     break
                 except Exception as e:
@@ -102,41 +276,61 @@ def sync_backups(cfg):
         raise
 
 
-def do_archive_backup(cfg):
+def compress_archive(cfg, vw, fileobj):
+    """Stream the gzip archive straight from data_dir into fileobj."""
+    arch = cfg.archive_dir_name()
+    # tarfile's own "w|gz" stream ignores compresslevel before Python 3.12
+    with (
+        gzip.GzipFile(
+            fileobj=fileobj, mode="wb", compresslevel=ARCHIVE_COMPRESS_LEVEL
+        ) as gz,
+        tarfile.open(fileobj=gz, mode="w|") as tar,
+    ):
+        tar.add(cfg.temp_dir, arch, recursive=False)
+        vw.add_to_archive(tar, f"{arch}/data")
+        tar.add(cfg.vaultwarden_json_path(), f"{arch}/vaultwarden.json")
+
+
+def do_archive_backup(cfg, throttle=None):
     from vaultwarden_service import VaultwardenService
 
     try:
-        with VaultwardenService(cfg) as vw:
-            vw.backup()
-        mkdir["-p", cfg.archive_dir_path()]()
-        mv[cfg.vaultwarden_data_backup_path(), f"{cfg.archive_dir_path()}/"]()
-        mv[cfg.vaultwarden_json_path(), f"{cfg.archive_dir_path()}/"]()
-
-        l.info("Compress vaultwarden data into tar archive...")
-        tar["-czf", cfg.archive_path(), "-C", cfg.temp_dir, cfg.archive_dir_name()]()
-        l.info("Vaultwarden data archived")
-
-        # Generate checksums for the unencrypted archive
-        l.info("Generating checksums for archive...")
-        generate_checksums(cfg.archive_path())
-
-        l.info("Encrypt archive with GPG...")
-        gpg_process = gpg[
-            "--batch",
-            "--yes",
-            "--passphrase-fd",
-            "0",
-            "--symmetric",
-            "--cipher-algo",
-            "AES256",
-            cfg.archive_path(),
-        ]
-        gpg_process(stdin=cfg.master_password.encode())
-        l.info("Archive encrypted")
+        with VaultwardenService(cfg, throttle) as vw:
+            with _stage(throttle, "Database backup"):
+                vw.backup()
+
+            # The plain archive never touches the disk, it is hashed on its way
+            # into gpg and only the database snapshot is staged
+            l.info("Compress and encrypt vaultwarden data...")
+            if throttle:
+                throttle.pace()
+            with _stage(throttle, "Compression and encryption"):
+                with gpg_encrypt_stream(
+                    cfg.encrypted_archive_path(), cfg.master_password
+                ) as gpg_stdin:
+                    archive = HashingWriter(gpg_stdin)
+                    compress_archive(cfg, vw, archive)
+            l.info("Vaultwarden data archived and encrypted")
+
+        _, archive_sha1 = _log_checksums(
+            cfg.archive_path(), archive.md5_hash, archive.sha1_hash
+        )
 
         # Generate checksums for the encrypted archive
         l.info("Generating checksums for encrypted archive...")
-        generate_checksums(cfg.encrypted_archive_path())
+        with _stage(throttle, "Encrypted archive checksums"):
+            _, encrypted_sha1 = generate_checksums(
+                cfg.encrypted_archive_path(), throttle
+            )
+
+        # Keep the checksums with the backup so compaction can verify it later
+        write_checksums(
+            cfg.checksums_path(),
+            {
+                os.path.basename(cfg.archive_path()): archive_sha1,
+                os.path.basename(cfg.encrypted_archive_path()): encrypted_sha1,
+            },
+        )
 
     except Exception as e:
         l.error(f"Failed to create archive backup: {e}")
@@ -153,11 +347,20 @@ def do_keepass_backup(cfg):
         with Bw(cfg) as bw:
             bw.export()
 
+        previous_keepass_db = None
+        if cfg.keepass_incremental:
+            previous_keepass_db = previous_keepass_db_path(cfg)
+
         with open(cfg.vaultwarden_json_path(), "r") as vaultwarden_json_file:
             keepass.run(
                 cfg.keepass_db_path(),
                 cfg.master_password,
                 json.load(vaultwarden_json_file),
+                kdf_memory=cfg.kdf_memory,
+                kdf_iterations=cfg.kdf_iterations,
+                kdf_parallelism=cfg.kdf_parallelism,
+                kdf_target_unlock_ms=cfg.kdf_target_unlock_ms,
+                previous_keepass_db=previous_keepass_db,
             )
 
         l.info("KeePassXC database created successfully")
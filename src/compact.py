@@ -0,0 +1,237 @@
+import fcntl
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from plumbum.cmd import gpg
+
+from backup_operations import (
+    COMPACT_LOCK_FILE,
+    COMPACT_TMP_PREFIX,
+    HashingWriter,
+    backups_lock,
+    gpg_encrypt_stream,
+    hash_file,
+    list_backups,
+    read_checksums,
+    write_checksums,
+)
+
+l = logging.getLogger(__name__)  # noqa: E741
+
+# xz preset 6 needs ~94 MiB per worker to compress, preset 9 would need ~674 MiB
+COMPACT_XZ_PRESET = 6 | lzma.PRESET_EXTREME
+CHUNK_SIZE = 1024 * 1024
+
+
+class _HashingReader:
+    """File wrapper that hashes everything read through it."""
+
+    def __init__(self, f, hash_obj):
+        self.f = f
+        self.hash_obj = hash_obj
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.hash_obj.update(chunk)
+        return chunk
+
+
+@contextmanager
+def gpg_decrypt(path, passphrase):
+    """Stream the decrypted content of a gpg file."""
+    process = gpg[
+        "--batch", "--quiet", "--passphrase-fd", "0", "--decrypt", path
+    ].popen(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.stdin.write(passphrase.encode())
+    process.stdin.close()
+    try:
+        yield process.stdout
+        # Drain what the consumer left so gpg can verify the integrity packet
+        while process.stdout.read(CHUNK_SIZE):
+            pass
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise Exception(f"gpg failed: {stderr.decode(errors='replace').strip()}")
+
+
+def _verify(name, actual, checksums):
+    expected = checksums.get(name)
+    if expected is not None and expected != actual:
+        raise Exception(f"Checksum mismatch for {name}: {actual} != {expected}")
+
+
+@contextmanager
+def compact_lock(cfg):
+    """Hold the compaction lock, a second run gives up instead of waiting."""
+    os.makedirs(cfg.backups_dir, exist_ok=True)
+    with open(os.path.join(cfg.backups_dir, COMPACT_LOCK_FILE), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Exception("Another compaction is already running")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def compact_generation(cfg, backup_dir):
+    """Re-encode one generation's gzip archive with xz.
+
+    Returns (old size, new size, whether stored checksums were verified), or
+    None if the generation was rotated away in the meantime.
+    """
+    gz_archive = os.path.basename(cfg.archive_path())
+    xz_archive = os.path.basename(cfg.compacted_archive_path())
+    source_name = os.path.basename(cfg.encrypted_archive_path())
+    target_name = os.path.basename(cfg.encrypted_compacted_archive_path())
+    source = os.path.join(backup_dir, source_name)
+    target = os.path.join(backup_dir, target_name)
+    # Written next to the generation, not inside it, and renamed in at the end
+    target_tmp = os.path.join(
+        os.path.dirname(backup_dir),
+        f"{COMPACT_TMP_PREFIX}{os.path.basename(backup_dir)}.tmp",
+    )
+    if not os.path.exists(source):
+        l.info(f"{backup_dir} was removed before compacting, skipping")
+        return None
+    checksums_path = os.path.join(backup_dir, os.path.basename(cfg.checksums_path()))
+    checksums = read_checksums(checksums_path)
+
+    l.info(f"Compact {backup_dir}...")
+    verified = source_name in checksums and gz_archive in checksums
+    if not verified:
+        # Backups made before checksums.sha1 existed
+        l.warning(
+            f"No stored checksums for {backup_dir}, relying on the gpg integrity "
+            "check and the gzip CRC32 instead"
+        )
+    _verify(source_name, hash_file(source)[1].hexdigest(), checksums)
+
+    try:
+        # Re-encode straight into gpg, hashing the old archive, the tar stream it
+        # contains and the new archive, nothing plain is written to disk
+        archive_sha1 = hashlib.sha1()
+        tar_sha1 = hashlib.sha1()
+        with (
+            gpg_decrypt(source, cfg.master_password) as stream,
+            gpg_encrypt_stream(target_tmp, cfg.master_password) as gpg_stdin,
+        ):
+            compacted = HashingWriter(gpg_stdin)
+            with (
+                gzip.GzipFile(fileobj=_HashingReader(stream, archive_sha1)) as gz,
+                lzma.open(compacted, "wb", preset=COMPACT_XZ_PRESET) as xz,
+            ):
+                # Reading to EOF makes gzip check the CRC32 and length trailer,
+                # a corrupt archive raises BadGzipFile here
+                for chunk in iter(lambda: gz.read(CHUNK_SIZE), b""):
+                    tar_sha1.update(chunk)
+                    xz.write(chunk)
+        _verify(gz_archive, archive_sha1.hexdigest(), checksums)
+
+        # Decrypt the new archive again and compare the tar stream
+        check_sha1 = hashlib.sha1()
+        with gpg_decrypt(target_tmp, cfg.master_password) as stream:
+            with lzma.open(stream) as xz:
+                for chunk in iter(lambda: xz.read(CHUNK_SIZE), b""):
+                    check_sha1.update(chunk)
+        if check_sha1.hexdigest() != tar_sha1.hexdigest():
+            raise Exception("Compacted archive does not match the original")
+        target_sha1 = hash_file(target_tmp)[1].hexdigest()
+
+        # Only the swap takes the backups lock, so a backup waits for one rename
+        # at most and never for a whole re-encode
+        with backups_lock(cfg):
+            if not os.path.exists(source):
+                l.info(f"{backup_dir} was removed while compacting, skipping")
+                os.remove(target_tmp)
+                return None
+
+            # Generations are ordered by name, the mtime is kept only for the user
+            dir_stat = os.stat(backup_dir)
+            os.replace(target_tmp, target)
+            checksums.pop(gz_archive, None)
+            checksums.pop(source_name, None)
+            checksums[xz_archive] = compacted.sha1_hash.hexdigest()
+            checksums[target_name] = target_sha1
+            write_checksums(checksums_path, checksums)
+
+            old_size = os.path.getsize(source)
+            os.remove(source)
+            os.utime(backup_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    except Exception:
+        if os.path.exists(target_tmp):
+            os.remove(target_tmp)
+        raise
+
+    new_size = os.path.getsize(target)
+    l.info(f"Compacted {backup_dir}: {old_size} -> {new_size} bytes")
+    return old_size, new_size, verified
+
+
+def compact_backups(cfg):
+    """Re-encode generations older than the most recent ones across cores."""
+    if not os.path.exists(cfg.backups_dir):
+        l.info("Backups directory doesn't exist, skipping compaction")
+        return
+
+    with compact_lock(cfg):
+        _compact_backups(cfg)
+
+
+def _compact_backups(cfg):
+    # Left behind by a run that was killed, safe to drop while we hold the lock
+    for name in os.listdir(cfg.backups_dir):
+        if name.startswith(COMPACT_TMP_PREFIX):
+            l.warning(f"Removing stale compaction file {name}")
+            os.remove(os.path.join(cfg.backups_dir, name))
+
+    # Backups may rotate generations away while we run, the swap checks for that
+    backups = list_backups(cfg)[cfg.compact_keep_recent :]
+    source_name = os.path.basename(cfg.encrypted_archive_path())
+    candidates = [d for d in backups if os.path.exists(os.path.join(d, source_name))]
+    if not candidates:
+        l.info("No backups to compact")
+        return
+
+    l.info(f"Compact {len(candidates)} backups...")
+    old_total = new_total = 0
+    failed = 0
+    unverified = 0
+    skipped = 0
+    with ProcessPoolExecutor(max_workers=cfg.compact_workers) as pool:
+        futures = {pool.submit(compact_generation, cfg, d): d for d in candidates}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                if result is None:
+                    skipped += 1
+                    continue
+                old_size, new_size, verified = result
+                old_total += old_size
+                new_total += new_size
+                unverified += not verified
+            except Exception as e:
+                l.error(f"Failed to compact {futures[future]}: {e}")
+                failed += 1
+
+    l.info(f"Backups compacted: {old_total} -> {new_total} bytes")
+    if skipped:
+        l.info(f"{skipped} backups were rotated away while compacting")
+    if unverified:
+        l.warning(
+            f"{unverified} backups had no stored checksums and were verified "
+            "by gpg and gzip CRC32 only"
+        )
+    if failed:
+        raise Exception(f"{failed} backups failed to compact")
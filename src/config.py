@@ -19,6 +19,18 @@ class Config:
         remotes=None,
         vaultwarden_url=None,
         sync_attempts=None,
+        kdf_memory=None,
+        kdf_iterations=None,
+        kdf_parallelism=None,
+        kdf_target_unlock_ms=None,
+        keepass_incremental=False,
+        throttle_io_pressure=None,
+        throttle_cpu_pressure=None,
+        throttle_nice=None,
+        throttle_ionice=None,
+        throttle_io_rate=None,
+        compact_keep_recent=None,
+        compact_workers=None,
     ):
         self.master_password = master_password
         self.client_id = client_id
@@ -30,6 +42,18 @@ class Config:
         self.remotes = remotes
         self.vaultwarden_url = vaultwarden_url
         self.sync_attempts = sync_attempts
+        self.kdf_memory = kdf_memory
+        self.kdf_iterations = kdf_iterations
+        self.kdf_parallelism = kdf_parallelism
+        self.kdf_target_unlock_ms = kdf_target_unlock_ms
+        self.keepass_incremental = keepass_incremental
+        self.throttle_io_pressure = throttle_io_pressure
+        self.throttle_cpu_pressure = throttle_cpu_pressure
+        self.throttle_nice = throttle_nice
+        self.throttle_ionice = throttle_ionice
+        self.throttle_io_rate = throttle_io_rate
+        self.compact_keep_recent = compact_keep_recent
+        self.compact_workers = compact_workers
 
     def __str__(self):
         return (
@@ -42,7 +66,19 @@ class Config:
             f"backups_keep_last={self.backups_keep_last}, "
             f"remotes={self.remotes}, "
             f"vaultwarden_url={self.vaultwarden_url}, "
-            f"sync_attempts={self.sync_attempts})"
+            f"sync_attempts={self.sync_attempts}, "
+            f"kdf_memory={self.kdf_memory}, "
+            f"kdf_iterations={self.kdf_iterations}, "
+            f"kdf_parallelism={self.kdf_parallelism}, "
+            f"kdf_target_unlock_ms={self.kdf_target_unlock_ms}, "
+            f"keepass_incremental={self.keepass_incremental}, "
+            f"throttle_io_pressure={self.throttle_io_pressure}, "
+            f"throttle_cpu_pressure={self.throttle_cpu_pressure}, "
+            f"throttle_nice={self.throttle_nice}, "
+            f"throttle_ionice={self.throttle_ionice}, "
+            f"throttle_io_rate={self.throttle_io_rate}, "
+            f"compact_keep_recent={self.compact_keep_recent}, "
+            f"compact_workers={self.compact_workers})"
         )
 
     def verify(self):
@@ -78,6 +114,65 @@ class Config:
                 "'--sync-attempts' or 'SYNC_ATTEMPTS' should be positive number"
             )
 
+        # KDF settings are optional, unset values keep the pykeepass defaults
+        kdf_settings = [
+            ("kdf-memory", "KDF_MEMORY", self.kdf_memory),
+            ("kdf-iterations", "KDF_ITERATIONS", self.kdf_iterations),
+            ("kdf-parallelism", "KDF_PARALLELISM", self.kdf_parallelism),
+            ("kdf-target-unlock-ms", "KDF_TARGET_UNLOCK_MS", self.kdf_target_unlock_ms),
+        ]
+        for arg, env, value in kdf_settings:
+            if value is not None and value <= 0:
+                raise Exception(f"'--{arg}' or '{env}' should be positive number")
+        if self.kdf_iterations is not None and self.kdf_target_unlock_ms is not None:
+            raise Exception(
+                "'--kdf-iterations' or 'KDF_ITERATIONS' cannot be combined with "
+                "'--kdf-target-unlock-ms' or 'KDF_TARGET_UNLOCK_MS'"
+            )
+
+        self._verify_throttle()
+
+    def verify_compact(self):
+        if not self.master_password:
+            raise Exception("'--master-password' or 'MASTER_PASSWORD' is required")
+        if not self.backups_dir:
+            raise Exception("'--backups-dir' or 'BACKUPS_DIR' is required")
+        if self.compact_keep_recent is None or self.compact_keep_recent < 0:
+            raise Exception(
+                "'--compact-keep-recent' or 'COMPACT_KEEP_RECENT' should be zero or positive number"
+            )
+        if self.compact_workers is not None and self.compact_workers <= 0:
+            raise Exception(
+                "'--compact-workers' or 'COMPACT_WORKERS' should be positive number"
+            )
+
+    def _verify_throttle(self):
+        pressure_settings = [
+            ("throttle-io-pressure", "THROTTLE_IO_PRESSURE", self.throttle_io_pressure),
+            (
+                "throttle-cpu-pressure",
+                "THROTTLE_CPU_PRESSURE",
+                self.throttle_cpu_pressure,
+            ),
+        ]
+        for arg, env, value in pressure_settings:
+            if value is not None and not 0 < value <= 100:
+                raise Exception(
+                    f"'--{arg}' or '{env}' should be a percentage between 0 and 100"
+                )
+        if self.throttle_nice is not None and not 0 <= self.throttle_nice <= 19:
+            raise Exception(
+                "'--throttle-nice' or 'THROTTLE_NICE' should be between 0 and 19"
+            )
+        if self.throttle_io_rate is not None and self.throttle_io_rate <= 0:
+            raise Exception(
+                "'--throttle-io-rate' or 'THROTTLE_IO_RATE' should be positive number"
+            )
+        if self.throttle_ionice not in (None, "idle", "best-effort"):
+            raise Exception(
+                "'--throttle-ionice' or 'THROTTLE_IONICE' should be 'idle' or 'best-effort'"
+            )
+
     def keepass_db_path(self):
         return f"{self.temp_dir}/passwords.kdbx"
 
@@ -99,6 +194,27 @@ class Config:
     def encrypted_archive_path(self):
         return f"{self.archive_dir_path()}.tar.gz.gpg"
 
+    def compacted_archive_path(self):
+        return f"{self.archive_dir_path()}.tar.xz"
+
+    def encrypted_compacted_archive_path(self):
+        return f"{self.archive_dir_path()}.tar.xz.gpg"
+
+    def checksums_path(self):
+        return f"{self.temp_dir}/checksums.sha1"
+
+
+def _optional_int(arg_value, env_name):
+    """Return an int from the argument or environment, or None if unset."""
+    value = arg_value if arg_value is not None else os.getenv(env_name)
+    return int(value) if value not in (None, "") else None
+
+
+def _optional_float(arg_value, env_name):
+    """Return a float from the argument or environment, or None if unset."""
+    value = arg_value if arg_value is not None else os.getenv(env_name)
+    return float(value) if value not in (None, "") else None
+
 
 def parse_config_from_args(args):
     """Parse configuration from command line arguments and environment variables."""
@@ -126,6 +242,32 @@ def parse_config_from_args(args):
     vaultwarden_url = args.vaultwarden_url or os.getenv("VAULTWARDEN_URL")
     sync_attempts = int(args.sync_attempts or os.getenv("SYNC_ATTEMPTS") or 3)
 
+    kdf_memory = _optional_int(args.kdf_memory, "KDF_MEMORY")
+    kdf_iterations = _optional_int(args.kdf_iterations, "KDF_ITERATIONS")
+    kdf_parallelism = _optional_int(args.kdf_parallelism, "KDF_PARALLELISM")
+    kdf_target_unlock_ms = _optional_int(
+        args.kdf_target_unlock_ms, "KDF_TARGET_UNLOCK_MS"
+    )
+
+    keepass_incremental = args.keepass_incremental or os.getenv(
+        "KEEPASS_INCREMENTAL", ""
+    ).strip().lower() in ("1", "true", "yes")
+
+    throttle_io_pressure = _optional_float(
+        args.throttle_io_pressure, "THROTTLE_IO_PRESSURE"
+    )
+    throttle_cpu_pressure = _optional_float(
+        args.throttle_cpu_pressure, "THROTTLE_CPU_PRESSURE"
+    )
+    throttle_nice = _optional_int(args.throttle_nice, "THROTTLE_NICE")
+    throttle_ionice = args.throttle_ionice or os.getenv("THROTTLE_IONICE") or None
+    throttle_io_rate = _optional_float(args.throttle_io_rate, "THROTTLE_IO_RATE")
+
+    compact_keep_recent = _optional_int(args.compact_keep_recent, "COMPACT_KEEP_RECENT")
+    if compact_keep_recent is None:
+        compact_keep_recent = 7
+    compact_workers = _optional_int(args.compact_workers, "COMPACT_WORKERS")
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     backups_dir = (
         args.backups_dir or os.getenv("BACKUPS_DIR") or f"{script_dir}/backups"
@@ -142,4 +284,16 @@ def parse_config_from_args(args):
         remotes=remotes,
         vaultwarden_url=vaultwarden_url,
         sync_attempts=sync_attempts,
+        kdf_memory=kdf_memory,
+        kdf_iterations=kdf_iterations,
+        kdf_parallelism=kdf_parallelism,
+        kdf_target_unlock_ms=kdf_target_unlock_ms,
+        keepass_incremental=keepass_incremental,
+        throttle_io_pressure=throttle_io_pressure,
+        throttle_cpu_pressure=throttle_cpu_pressure,
+        throttle_nice=throttle_nice,
+        throttle_ionice=throttle_ionice,
+        throttle_io_rate=throttle_io_rate,
+        compact_keep_recent=compact_keep_recent,
+        compact_workers=compact_workers,
     )
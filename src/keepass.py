@@ -1,15 +1,26 @@
 import argparse
 import json
 import logging
+import os
+import time
 from uuid import uuid4
 
+import argon2.low_level
 import pykeepass
+from lxml import etree
 
 import utils
 
 l = logging.getLogger(__name__)  # noqa: E741
 
 
+# Number of Argon2 passes used to measure the per-iteration cost
+KDF_CALIBRATION_PROBE_ITERATIONS = 2
+
+# Argon2 parameters of the pykeepass blank database template
+KDF_DEFAULT_PARAMETERS = {"memory": 64, "iterations": 14, "parallelism": 2}
+
+
 # Create a new KeePassXC database
 def create_keepass_db(db_path, master_password):
     l.info("Create keepass database...")
@@ -18,6 +29,119 @@ def create_keepass_db(db_path, master_password):
     return kp
 
 
+def get_kdf_parameters(kp):
+    """Return the Argon2 parameters stored in the KDBX4 header."""
+    params = kp.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+    return {
+        "memory": params["M"].value // (1024 * 1024),
+        "iterations": params["I"].value,
+        "parallelism": params["P"].value,
+    }
+
+
+# Override the Argon2 parameters, unset values are left as they are in the header
+def set_kdf_parameters(kp, memory=None, iterations=None, parallelism=None):
+    params = kp.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+    if memory:
+        params["M"].value = memory * 1024 * 1024
+    if iterations:
+        params["I"].value = iterations
+    if parallelism:
+        params["P"].value = parallelism
+
+
+def calibrate_kdf_iterations(memory, parallelism, target_unlock_ms):
+    """Benchmark Argon2 on this host and pick iterations for the target unlock time."""
+    l.info(f"Calibrate KDF for {target_unlock_ms} ms unlock time...")
+    start = time.perf_counter()
+    argon2.low_level.hash_secret_raw(
+        secret=b"vaultwarden-backup-calibration",
+        salt=bytes(32),
+        time_cost=KDF_CALIBRATION_PROBE_ITERATIONS,
+        memory_cost=memory * 1024,
+        parallelism=parallelism,
+        hash_len=32,
+        type=argon2.low_level.Type.D,
+    )
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    per_iteration_ms = elapsed_ms / KDF_CALIBRATION_PROBE_ITERATIONS
+    iterations = max(1, int(target_unlock_ms / per_iteration_ms))
+    l.debug(f"Argon2 iteration takes {per_iteration_ms:.1f} ms")
+    l.info(f"KDF calibrated: {iterations} iterations")
+    return iterations
+
+
+# Bitwarden ids are tracked on the KeePass side so later runs can update in place
+BITWARDEN_ID_PROPERTY = "BitwardenId"
+BITWARDEN_REVISION_PROPERTY = "BitwardenRevisionDate"
+BITWARDEN_FOLDER_ID_KEY = "BitwardenFolderId"
+
+# Entry history limit when the database Meta has no usable HistoryMaxItems
+HISTORY_MAX_ITEMS = 10
+
+
+# Open an existing KeePassXC database
+def open_keepass_db(db_path, master_password):
+    l.info(f"Open previous keepass database {db_path}...")
+    kp = pykeepass.PyKeePass(db_path, master_password)
+    l.info("Previous keepass database opened")
+    return kp
+
+
+def get_group_custom_data(group, key):
+    """Read a value from the group's KDBX CustomData block."""
+    value = group._element.xpath(f"CustomData/Item[Key='{key}']/Value")
+    return value[0].text if value else None
+
+
+def set_group_custom_data(group, key, value):
+    """Write a value into the group's KDBX CustomData block."""
+    custom_data = group._element.find("CustomData")
+    if custom_data is None:
+        custom_data = etree.Element("CustomData")
+        # Keep CustomData ahead of child entries and groups, as in the KDBX schema
+        children = group._element.xpath("Entry|Group")
+        if children:
+            children[0].addprevious(custom_data)
+        else:
+            group._element.append(custom_data)
+    for item in custom_data.xpath(f"Item[Key='{key}']"):
+        custom_data.remove(item)
+    item = etree.SubElement(custom_data, "Item")
+    etree.SubElement(item, "Key").text = key
+    etree.SubElement(item, "Value").text = value
+
+
+def history_max_items(kp):
+    """Return the Meta HistoryMaxItems limit of the database, -1 means unlimited."""
+    value = kp.tree.xpath("/KeePassFile/Meta/HistoryMaxItems")
+    try:
+        return int(value[0].text)
+    except (IndexError, TypeError, ValueError):
+        return HISTORY_MAX_ITEMS
+
+
+# pykeepass does not enforce HistoryMaxItems, drop the oldest versions ourselves
+def trim_history(entry, max_items):
+    if max_items < 0:
+        return
+    history = entry.history
+    for old in history[: max(len(history) - max_items, 0)]:
+        entry.delete_history(old)
+
+
+# Extract the KeePass entry fields from a Bitwarden item
+def entry_fields(item):
+    uris = item.get("login", {}).get("uris", [])
+    return {
+        "title": item.get("name", f"Nameless-{str(uuid4())}"),
+        "username": item.get("login", {}).get("username", ""),
+        "password": item.get("login", {}).get("password", ""),
+        "url": uris[0].get("uri") if uris else None,
+        "notes": item.get("notes"),
+    }
+
+
 # Add groups
 def make_groups(kp, folders_raw):
     l.info("Add groups to keepass db...")
@@ -26,48 +150,196 @@ def make_groups(kp, folders_raw):
         folder_id = folder["id"]
         folder_name = folder["name"]
         group = kp.add_group(kp.root_group, folder_name)  # Add the group to KeePass
+        set_group_custom_data(group, BITWARDEN_FOLDER_ID_KEY, folder_id)
         groups[folder_id] = group
         l.debug(f"Group added: {folder_name}")
     l.info("Groups added")
     return groups
 
 
+# Add a single entry and tag it with its Bitwarden id and revision
+def add_entry(kp, item, group):
+    fields = entry_fields(item)
+    entry = kp.add_entry(
+        group,
+        fields["title"],
+        fields["username"],
+        fields["password"],
+        url=fields["url"],
+        notes=fields["notes"],
+        force_creation=True,
+    )
+    if item.get("id"):
+        entry.set_custom_property(BITWARDEN_ID_PROPERTY, item["id"])
+    if item.get("revisionDate"):
+        entry.set_custom_property(BITWARDEN_REVISION_PROPERTY, item["revisionDate"])
+    return entry
+
+
 # Add entries in KeePass
 def add_entries(kp, items_raw, groups):
     l.info("Add entries to keepass db...")
     for item in items_raw:
-        name = item.get("name", f"Nameless-{str(uuid4())}")
-        username = item.get("login", {}).get("username", "")
-        password = item.get("login", {}).get("password", "")
-        url = item.get("login", {}).get("uris", [])
-        url = url[0].get("uri") if url else None
-        notes = item.get("notes")
         folder_id = item.get("folderId")
         group = groups.get(folder_id, kp.root_group)
 
         # Create an entry in KeePass
-        kp.add_entry(group, name, username, password, url=url, notes=notes)
+        entry = add_entry(kp, item, group)
 
-        l.debug(f"Entry added: {name}")
+        l.debug(f"Entry added: {entry.title}")
     l.info("Entries added")
 
 
-def run(keepass_db, keepass_password, vaultwarden_json):
+# Bring groups in line with the Bitwarden folders
+def sync_groups(kp, folders_raw):
+    l.info("Sync groups in keepass db...")
+    existing = {}
+    untracked = []
+    for group in kp.root_group.subgroups:
+        folder_id = get_group_custom_data(group, BITWARDEN_FOLDER_ID_KEY)
+        if folder_id:
+            existing[folder_id] = group
+        else:
+            untracked.append(group)
+
+    groups = {}
+    for folder in folders_raw:
+        folder_id = folder["id"]
+        folder_name = folder["name"]
+        group = existing.pop(folder_id, None)
+        if group is None:
+            group = kp.add_group(kp.root_group, folder_name)
+            set_group_custom_data(group, BITWARDEN_FOLDER_ID_KEY, folder_id)
+            l.debug(f"Group added: {folder_name}")
+        elif group.name != folder_name:
+            group.name = folder_name
+            group.touch(modify=True)
+            l.debug(f"Group renamed: {folder_name}")
+        groups[folder_id] = group
+
+    removed = list(existing.values()) + untracked
+    l.info(f"Groups synced ({len(removed)} removed)")
+    return groups, removed
+
+
+# Apply adds, updates and deletes based on the Bitwarden revisionDate
+def sync_entries(kp, items_raw, groups):
+    l.info("Sync entries in keepass db...")
+    existing = {}
+    for entry in kp.entries:
+        item_id = entry.get_custom_property(BITWARDEN_ID_PROPERTY)
+        if item_id:
+            existing[item_id] = entry
+        else:
+            # Entries written before ids were tracked cannot be matched, rebuild them
+            kp.delete_entry(entry)
+
+    max_history = history_max_items(kp)
+    added = updated = 0
+    for item in items_raw:
+        group = groups.get(item.get("folderId"), kp.root_group)
+        entry = existing.pop(item.get("id"), None)
+        if entry is None:
+            add_entry(kp, item, group)
+            added += 1
+            continue
+
+        if entry.group.uuid != group.uuid:
+            kp.move_entry(entry, group)
+
+        revision = item.get("revisionDate")
+        if (
+            revision
+            and entry.get_custom_property(BITWARDEN_REVISION_PROPERTY) == revision
+        ):
+            continue
+
+        # Keep the previous version in the KeePass entry history
+        entry.save_history()
+        trim_history(entry, max_history)
+        for field, value in entry_fields(item).items():
+            # pykeepass cannot store None, cleared fields become empty strings
+            setattr(entry, field, value or "")
+        if revision:
+            entry.set_custom_property(BITWARDEN_REVISION_PROPERTY, revision)
+        entry.touch(modify=True)
+        updated += 1
+        l.debug(f"Entry updated: {entry.title}")
+
+    for entry in existing.values():
+        kp.delete_entry(entry)
+
+    l.info(
+        f"Entries synced: {added} added, {updated} updated, " f"{len(existing)} deleted"
+    )
+
+
+def run(
+    keepass_db,
+    keepass_password,
+    vaultwarden_json,
+    kdf_memory=None,
+    kdf_iterations=None,
+    kdf_parallelism=None,
+    kdf_target_unlock_ms=None,
+    previous_keepass_db=None,
+):
     # Step 1: Load data from JSON
     folders_raw = vaultwarden_json["folders"]
     items_raw = vaultwarden_json["items"]
 
-    # Step 2: Create the KeePass db
-    kp = create_keepass_db(keepass_db, keepass_password)
+    # Step 2: Open the previous KeePass db, or create a new one, and apply KDF settings
+    kp = None
+    if previous_keepass_db and os.path.exists(previous_keepass_db):
+        try:
+            kp = open_keepass_db(previous_keepass_db, keepass_password)
+        except Exception as e:
+            l.warning(f"Cannot open previous keepass database, rebuilding: {e}")
+    elif previous_keepass_db:
+        l.info("No previous keepass database found, rebuilding")
+    incremental = kp is not None
+    if not incremental:
+        kp = create_keepass_db(keepass_db, keepass_password)
+    else:
+        # The previous file carries its own parameters, unset values go back to defaults
+        set_kdf_parameters(kp, **KDF_DEFAULT_PARAMETERS)
+
+    set_kdf_parameters(kp, kdf_memory, kdf_iterations, kdf_parallelism)
+    if kdf_target_unlock_ms:
+        if kdf_iterations:
+            l.warning(
+                f"KDF calibration overrides the configured {kdf_iterations} iterations"
+            )
+        kdf = get_kdf_parameters(kp)
+        iterations = calibrate_kdf_iterations(
+            kdf["memory"], kdf["parallelism"], kdf_target_unlock_ms
+        )
+        set_kdf_parameters(kp, iterations=iterations)
+    kdf = get_kdf_parameters(kp)
+    l.info(
+        f"KDF parameters: Argon2 memory={kdf['memory']} MiB, "
+        f"iterations={kdf['iterations']}, parallelism={kdf['parallelism']}"
+    )
+
+    if incremental:
+        # Step 3: Update groups in place
+        groups, removed_groups = sync_groups(kp, folders_raw)
 
-    # Step 3: Add groups to KeePass db
-    groups = make_groups(kp, folders_raw)
+        # Step 4: Apply entry changes, then drop groups of deleted folders
+        sync_entries(kp, items_raw, groups)
+        for group in removed_groups:
+            kp.delete_group(group)
+    else:
+        # Step 3: Add groups to KeePass db
+        groups = make_groups(kp, folders_raw)
 
-    # Step 4: Add entries
-    add_entries(kp, items_raw, groups)
+        # Step 4: Add entries
+        add_entries(kp, items_raw, groups)
 
     # Step 5: Save the database after adding all entries
+    start = time.perf_counter()
     kp.save(keepass_db)
+    l.info(f"Keepass database saved in {time.perf_counter() - start:.2f} s")
 
 
 # Load data from the JSON file
@@ -98,12 +370,33 @@ def main():
         required=True,
         help="Path to the Vaultwarden JSON export file",
     )
+    parser.add_argument(
+        "--previous-keepass-db",
+        help="Previous KeePass database to update incrementally",
+    )
+    parser.add_argument("--kdf-memory", type=int, help="Argon2 memory in MiB")
+    parser.add_argument("--kdf-iterations", type=int, help="Argon2 iterations")
+    parser.add_argument("--kdf-parallelism", type=int, help="Argon2 parallelism")
+    parser.add_argument(
+        "--kdf-target-unlock-ms",
+        type=int,
+        help="Calibrate Argon2 iterations for this unlock time in milliseconds",
+    )
 
     args = parser.parse_args()
 
     utils.setup_logging(args.verbose)
     vaultwarden_json = load_json(args.vaultwarden_json)
-    run(args.keepass_db, args.keepass_password, vaultwarden_json)
+    run(
+        args.keepass_db,
+        args.keepass_password,
+        vaultwarden_json,
+        kdf_memory=args.kdf_memory,
+        kdf_iterations=args.kdf_iterations,
+        kdf_parallelism=args.kdf_parallelism,
+        kdf_target_unlock_ms=args.kdf_target_unlock_ms,
+        previous_keepass_db=args.previous_keepass_db,
+    )
 
 
 if __name__ == "__main__":
@@ -3,14 +3,17 @@ import logging
 import sys
 
 from backup_operations import (
+    backups_lock,
     create_backup,
     do_archive_backup,
     do_keepass_backup,
     rotate_backups,
     sync_backups,
 )
+from compact import compact_backups
 from config import parse_config_from_args
 from temp_manager import secure_temp_directory
+from throttle import Throttle
 from utils import setup_logging
 
 l = logging.getLogger(__name__)  # noqa: E741
@@ -27,6 +30,13 @@ def parse_arguments():
         description="Script for interacting with Vaultwarden and KeePass."
     )
 
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="backup",
+        choices=["backup", "compact"],
+        help="Create a new backup (default) or compact old backups.",
+    )
     parser.add_argument(
         "-v", "--verbose", action="count", help="Logging verbosity level."
     )
@@ -51,6 +61,54 @@ def parse_arguments():
         type=int,
         help="Number of attempts to synchronize with remotes",
     )
+    parser.add_argument("--kdf-memory", type=int, help="KeePass Argon2 memory in MiB.")
+    parser.add_argument("--kdf-iterations", type=int, help="KeePass Argon2 iterations.")
+    parser.add_argument(
+        "--kdf-parallelism", type=int, help="KeePass Argon2 parallelism."
+    )
+    parser.add_argument(
+        "--kdf-target-unlock-ms",
+        type=int,
+        help="Calibrate KeePass Argon2 iterations for this unlock time (ms).",
+    )
+    parser.add_argument(
+        "--keepass-incremental",
+        action="store_true",
+        help="Update the previous backup's KeePass database instead of rebuilding it.",
+    )
+    parser.add_argument(
+        "--throttle-io-pressure",
+        type=float,
+        help="Pause backup stages while IO some-avg10 pressure is above this percent.",
+    )
+    parser.add_argument(
+        "--throttle-cpu-pressure",
+        type=float,
+        help="Pause backup stages while CPU some-avg10 pressure is above this percent.",
+    )
+    parser.add_argument(
+        "--throttle-nice", type=int, help="Niceness of the backup process (0-19)."
+    )
+    parser.add_argument(
+        "--throttle-ionice",
+        choices=["idle", "best-effort"],
+        help="I/O scheduling class of the backup process.",
+    )
+    parser.add_argument(
+        "--throttle-io-rate",
+        type=float,
+        help="Ceiling for the backup process's own disk I/O in MiB/s.",
+    )
+    parser.add_argument(
+        "--compact-keep-recent",
+        type=int,
+        help="Number of most recent backups that compaction leaves untouched.",
+    )
+    parser.add_argument(
+        "--compact-workers",
+        type=int,
+        help="Number of parallel compaction processes (default: CPU count).",
+    )
 
     return parser.parse_args()
 
@@ -72,12 +130,20 @@ def main():
         cfg = config_partial
 
         try:
+            if args.command == "compact":
+                cfg.verify_compact()
+                # Priority comes from the systemd unit, THROTTLE_* only apply to backups
+                compact_backups(cfg)
+                l.info("Compaction completed successfully")
+                return
+
             cfg.verify()
-            do_keepass_backup(cfg)
-            do_archive_backup(cfg)
-            create_backup(cfg)
-            rotate_backups(cfg)
-            sync_backups(cfg)
+            with backups_lock(cfg), Throttle(cfg) as throttle:
+                do_keepass_backup(cfg)
+                do_archive_backup(cfg, throttle)
+                create_backup(cfg)
+                rotate_backups(cfg)
+                sync_backups(cfg)
             l.info("Backup completed successfully")
         except Exception as e:
             on_error(e)
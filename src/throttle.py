@@ -0,0 +1,189 @@
+import logging
+import time
+from contextlib import contextmanager
+
+import psutil
+
+l = logging.getLogger(__name__)  # noqa: E741
+
+PRESSURE_DIR = "/proc/pressure"
+
+# PSI averages are refreshed every 2 seconds, no point in reading more often
+PRESSURE_CHECK_INTERVAL = 1.0
+# Sleep step while the host is under pressure
+THROTTLE_SLEEP = 0.5
+# Upper bound for a single pause, so a busy host slows the backup but never stalls it
+THROTTLE_MAX_WAIT = 30.0
+
+IONICE_CLASSES = {
+    "idle": psutil.IOPRIO_CLASS_IDLE,
+    "best-effort": psutil.IOPRIO_CLASS_BE,
+}
+# I/O classes from highest to lowest priority
+IONICE_ORDER = [
+    psutil.IOPRIO_CLASS_RT,
+    psutil.IOPRIO_CLASS_BE,
+    psutil.IOPRIO_CLASS_IDLE,
+]
+
+
+def read_pressure(resource):
+    """Return the 'some avg10' pressure of a resource in percent, or None."""
+    try:
+        with open(f"{PRESSURE_DIR}/{resource}", "r") as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    return float(dict(v.split("=") for v in fields[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+        return None
+    return None
+
+
+class Throttle:
+    """Pace backup stages so they only use idle capacity of the host."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        # Ceiling for this process's own storage I/O in bytes per second
+        self.io_rate = (
+            cfg.throttle_io_rate * 1024 * 1024 if cfg.throttle_io_rate else None
+        )
+        self.targets = {
+            resource: target
+            for resource, target in (
+                ("io", cfg.throttle_io_pressure),
+                ("cpu", cfg.throttle_cpu_pressure),
+            )
+            if target is not None
+        }
+        self.process = psutil.Process()
+        self.last_check = 0.0
+        self.last_io = None
+        self.throttled = 0.0
+        self.current_stage = None
+
+    def __enter__(self):
+        self._set_priority()
+        for resource in list(self.targets):
+            if read_pressure(resource) is None:
+                l.warning(f"Pressure stall information for {resource} unavailable")
+                del self.targets[resource]
+        if self.targets:
+            l.info(f"Throttling on pressure targets: {self.targets}")
+        if self.io_rate:
+            l.info(f"Limiting own I/O to {self.cfg.throttle_io_rate} MiB/s")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.enabled:
+            l.info(f"Backup throttled for {self.throttled:.1f} s in total")
+        return False
+
+    @property
+    def enabled(self):
+        """Whether pressure or I/O rate based pacing is active."""
+        return bool(self.targets) or bool(self.io_rate)
+
+    def _set_priority(self):
+        """Lower CPU and I/O priority, inherited by tar and gpg subprocesses.
+
+        The priority is never raised, so a stricter Nice= or IOSchedulingClass=
+        of the systemd unit wins.
+        """
+        if self.cfg.throttle_nice is not None:
+            try:
+                current = self.process.nice()
+                if self.cfg.throttle_nice > current:
+                    self.process.nice(self.cfg.throttle_nice)
+                    l.info(f"Process niceness set to {self.cfg.throttle_nice}")
+                else:
+                    l.info(f"Process niceness is already {current}, keeping it")
+            except Exception as e:
+                l.warning(f"Failed to set niceness: {e}")
+        if self.cfg.throttle_ionice is not None:
+            try:
+                current = self.process.ionice().ioclass
+                if current == psutil.IOPRIO_CLASS_NONE:
+                    # No class set means best-effort derived from niceness
+                    current = psutil.IOPRIO_CLASS_BE
+                target = IONICE_CLASSES[self.cfg.throttle_ionice]
+                if IONICE_ORDER.index(target) > IONICE_ORDER.index(current):
+                    self.process.ionice(target)
+                    l.info(f"Process I/O class set to {self.cfg.throttle_ionice}")
+                else:
+                    l.info(f"Process I/O class is already {current.name}, keeping it")
+            except Exception as e:
+                l.warning(f"Failed to set I/O class: {e}")
+
+    def _over_target(self):
+        for resource, target in self.targets.items():
+            pressure = read_pressure(resource)
+            if pressure is not None and pressure > target:
+                l.debug(f"{resource} pressure {pressure:.2f}% above {target}%")
+                return True
+        return False
+
+    def _io_rate_delay(self, now):
+        """Seconds to sleep so our own I/O since the last check stays under the ceiling."""
+        io = self._io_counters()
+        if io is None:
+            return 0.0
+        total = io.read_bytes + io.write_bytes
+        delay = 0.0
+        if self.last_io is not None:
+            io_time, io_bytes = self.last_io
+            delay = (total - io_bytes) / self.io_rate - (now - io_time)
+        self.last_io = (now, total)
+        return max(delay, 0.0)
+
+    def pace(self):
+        """Pause while the host is above a pressure target or our I/O is too fast."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self.last_check < PRESSURE_CHECK_INTERVAL:
+            return
+        self.last_check = now
+
+        waited = 0.0
+        if self.io_rate:
+            waited = min(self._io_rate_delay(now), THROTTLE_MAX_WAIT)
+            time.sleep(waited)
+        while waited < THROTTLE_MAX_WAIT and self._over_target():
+            time.sleep(THROTTLE_SLEEP)
+            waited += THROTTLE_SLEEP
+        if waited:
+            self.throttled += waited
+            self.last_check = time.monotonic()
+            if self.last_io is not None:
+                self.last_io = (self.last_check, self.last_io[1])
+            l.debug(f"Throttled {self.current_stage or 'backup'} for {waited:.1f} s")
+
+    @contextmanager
+    def stage(self, name):
+        """Log the duration and this process's own I/O for a backup stage."""
+        self.current_stage = name
+        start = time.monotonic()
+        io_start = self._io_counters()
+        try:
+            yield self
+        finally:
+            elapsed = time.monotonic() - start
+            io_end = self._io_counters()
+            if io_start and io_end:
+                read_mb = (io_end.read_bytes - io_start.read_bytes) / 1024 / 1024
+                write_mb = (io_end.write_bytes - io_start.write_bytes) / 1024 / 1024
+                l.info(
+                    f"{name}: {elapsed:.2f} s, "
+                    f"read {read_mb:.1f} MiB, written {write_mb:.1f} MiB"
+                )
+            else:
+                l.info(f"{name}: {elapsed:.2f} s")
+            self.current_stage = None
+
+    def _io_counters(self):
+        try:
+            return self.process.io_counters()
+        except Exception:
+            return None
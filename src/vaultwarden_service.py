@@ -1,14 +1,31 @@
 import logging
 import os
-import shutil
 import sqlite3
 
 l = logging.getLogger(__name__)  # noqa: E741
 
+# Times a file is read before giving up on it changing underneath us
+STABLE_READ_ATTEMPTS = 3
+
+# Backup files as specified in official Vaultwarden wiki
+FILES_TO_BACKUP = [
+    "config.json",  # Admin config (recommended)
+    "rsa_key.der",  # Authentication tokens (recommended)
+    "rsa_key.pem",
+    "rsa_key.pub.der",
+    "rsa_key.pub.pem",
+]
+
+DIRECTORIES_TO_BACKUP = [
+    "attachments",  # File attachments (required)
+    "sends",  # Send attachments (optional but included)
+]
+
 
 class VaultwardenService:
-    def __init__(self, cfg):
+    def __init__(self, cfg, throttle=None):
         self.cfg = cfg
+        self.throttle = throttle
 
     def __enter__(self):
         # Don't stop the service - SQLite supports online backup
@@ -20,9 +37,13 @@ class VaultwardenService:
         l.info("Archive backup completed, service was never interrupted")
         return False
 
+    def _pace(self):
+        if self.throttle:
+            self.throttle.pace()
+
     def backup(self):
-        """Backup vaultwarden data files for archive creation."""
-        l.info("Backup vaultwarden data (online backup)...")
+        """Snapshot the SQLite database, the only file staged before archiving."""
+        l.info("Backup vaultwarden database (online backup)...")
 
         # Create backup directory first
         os.makedirs(self.cfg.vaultwarden_data_backup_path(), exist_ok=True)
@@ -39,7 +60,11 @@ class VaultwardenService:
                     f"file:{db_source}?mode=ro", uri=True, timeout=30.0
                 )
                 backup_conn = sqlite3.connect(db_backup)
+                # One step only: SQLite restarts a stepped backup from page 0
+                # whenever Vaultwarden writes in between, so pace around it
+                self._pace()
                 source_conn.backup(backup_conn)
+                self._pace()
                 source_conn.close()
                 backup_conn.close()
                 l.info("Database backup completed using Online Backup API")
@@ -49,40 +74,81 @@ class VaultwardenService:
         else:
             l.warning(f"Database file not found: {db_source}")
 
-        # Backup files as specified in official Vaultwarden wiki
-        files_to_backup = [
-            "config.json",  # Admin config (recommended)
-            "rsa_key.der",  # Authentication tokens (recommended)
-            "rsa_key.pem",
-            "rsa_key.pub.der",
-            "rsa_key.pub.pem",
-        ]
-
-        directories_to_backup = [
-            "attachments",  # File attachments (required)
-            "sends",  # Send attachments (optional but included)
-        ]
-
-        # Copy individual files
-        for filename in files_to_backup:
+    def add_to_archive(self, tar, arcname):
+        """Stream the database snapshot and data files from data_dir into tar."""
+        l.info("Archive vaultwarden data from data directory...")
+        tar.add(self.cfg.data_dir, arcname, recursive=False)
+
+        db_backup = f"{self.cfg.vaultwarden_data_backup_path()}/db.sqlite3"
+        if os.path.exists(db_backup):
+            self._add_file(tar, db_backup, f"{arcname}/db.sqlite3")
+
+        for filename in FILES_TO_BACKUP:
             source_file = f"{self.cfg.data_dir}/{filename}"
             if os.path.exists(source_file):
-                l.info(f"Backing up file: {filename}")
-                shutil.copy2(
-                    source_file, f"{self.cfg.vaultwarden_data_backup_path()}/{filename}"
-                )
+                l.info(f"Archiving file: {filename}")
+                self._add_file(tar, source_file, f"{arcname}/{filename}")
 
-        # Copy directories
-        for dirname in directories_to_backup:
+        for dirname in DIRECTORIES_TO_BACKUP:
             source_dir = f"{self.cfg.data_dir}/{dirname}"
-            if os.path.exists(source_dir):
-                l.info(f"Backing up directory: {dirname}")
-                shutil.copytree(
-                    source_dir,
-                    f"{self.cfg.vaultwarden_data_backup_path()}/{dirname}",
-                    dirs_exist_ok=True,
-                )
+            if not os.path.exists(source_dir):
+                continue
+            l.info(f"Archiving directory: {dirname}")
+            for root, dirs, files in os.walk(source_dir):
+                dirs.sort()
+                relative = os.path.relpath(root, self.cfg.data_dir)
+                tar.add(root, f"{arcname}/{relative}", recursive=False)
+                for filename in sorted(files):
+                    self._add_file(
+                        tar,
+                        os.path.join(root, filename),
+                        f"{arcname}/{relative}/{filename}",
+                    )
 
         # Skip icon_cache as it's optional and not worth backing up according to wiki
 
-        l.info("Vaultwarden data backup completed (service kept running)")
+        l.info("Vaultwarden data archived (service kept running)")
+
+    def _add_file(self, tar, path, arcname):
+        """Add a file to tar, re-adding it if its size or mtime changed during the read."""
+        for _ in range(STABLE_READ_ATTEMPTS):
+            try:
+                with open(path, "rb") as f:
+                    before = os.fstat(f.fileno())
+                    tarinfo = tar.gettarinfo(arcname=arcname, fileobj=f)
+                    tar.addfile(tarinfo, _PacedReader(f, tarinfo.size, self._pace))
+                    after = os.fstat(f.fileno())
+            except FileNotFoundError:
+                l.warning(f"File removed before it could be archived: {path}")
+                return
+
+            if (before.st_size, before.st_mtime_ns) == (
+                after.st_size,
+                after.st_mtime_ns,
+            ):
+                return
+            # The inconsistent copy stays in the archive (a short read is zero
+            # padded), extraction overwrites it with the last copy of the member
+            l.warning(f"File changed while archiving, adding it again: {path}")
+
+        raise Exception(f"File kept changing while archiving: {path}")
+
+
+class _PacedReader:
+    """File wrapper that paces reads and zero pads a file that shrank, like GNU tar."""
+
+    def __init__(self, f, size, pace):
+        self.f = f
+        self.remaining = size
+        self.pace = pace
+
+    def read(self, size=-1):
+        self.pace()
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        # tarfile aborts on a short read and leaves a half written member
+        if len(data) < size:
+            data += bytes(size - len(data))
+        self.remaining -= len(data)
+        return data